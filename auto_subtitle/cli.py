@@ -1,19 +1,38 @@
 import os
+import sys
 import ffmpeg
-import whisper
 import argparse
+import numpy as np
+from typing import Iterable
 import warnings
 import tempfile
-from .utils import filename, str2bool, write_srt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from ctranslate2 import get_cuda_device_count
+from faster_whisper import BatchedInferencePipeline, WhisperModel, available_models
+from .utils import encoder_works, filename, format_timestamp, get_audio_codec, get_duration, get_encoders, get_temp_dir, has_audio_stream, str2bool, write_srt
+
+_MODEL_CACHE = {}
+
+HW_ENCODERS = {
+    "nvenc": "h264_nvenc",
+    "qsv": "h264_qsv",
+    "vaapi": "h264_vaapi",
+    "videotoolbox": "h264_videotoolbox",
+}
+
+# audio codecs that can be stream-copied into the .mp4 output as they are
+MP4_AUDIO_CODECS = {"aac", "mp3", "ac3", "eac3", "alac"}
 
 
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("video", nargs="+", type=str,
-                        help="paths to video files to transcribe")
+                        help="paths to video files to transcribe; use '-' to read paths from stdin, one per line")
     parser.add_argument("--model", default="small",
-                        choices=whisper.available_models(), help="name of the Whisper model to use")
+                        choices=available_models(), help="name of the Whisper model to use")
     parser.add_argument("--output_dir", "-o", type=str,
                         default=".", help="directory to save the outputs")
     parser.add_argument("--output_srt", type=str2bool, default=False,
@@ -22,6 +41,22 @@ def main():
                         help="only generate the .srt file and not create overlayed video")
     parser.add_argument("--verbose", type=str2bool, default=False,
                         help="whether to print out the progress and debug messages")
+    parser.add_argument("--device", type=str, default="cuda" if get_cuda_device_count() > 0 else "cpu",
+                        choices=["cpu", "cuda"], help="device to use for Whisper inference")
+    parser.add_argument("--fp16", type=str2bool, default=True,
+                        help="whether to perform inference in fp16 on CUDA devices; CPU inference always uses int8")
+    parser.add_argument("--flash_attention", type=str2bool, default=False,
+                        help="whether to use Flash Attention on CUDA devices; requires an Ampere or newer GPU")
+    parser.add_argument("--batch_size", type=int, default=16,
+                        help="number of audio chunks to transcribe in one batch; 1 disables batched inference")
+    parser.add_argument("--chunk_seconds", type=int, default=30,
+                        help="maximum length in seconds (1-30) of the audio chunks split at silences; only used with batched inference")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="number of ffmpeg subtitle overlay jobs to run concurrently")
+    parser.add_argument("--hwaccel", type=str, default="none", choices=["auto", "none", *HW_ENCODERS],
+                        help="hardware video encoder to use when adding subtitles; 'auto' picks the first one that works on this machine")
+    parser.add_argument("--vaapi_device", type=str, default="/dev/dri/renderD128",
+                        help="DRM render node to use with --hwaccel vaapi")
 
     parser.add_argument("--task", type=str, default="transcribe", choices=[
                         "transcribe", "translate"], help="whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')")
@@ -29,11 +64,28 @@ def main():
     help="What is the origin language of the video? If unset, it is detected automatically.")
 
     args = parser.parse_args().__dict__
+
+    # Whisper decodes fixed 30 s windows, longer chunks would be truncated
+    if not 1 <= args["chunk_seconds"] <= 30:
+        parser.error("--chunk_seconds must be between 1 and 30")
+
+    # CTranslate2's flash attention only runs in float16
+    if args["flash_attention"] and args["device"] == "cuda" and not args["fp16"]:
+        parser.error("--flash_attention requires fp16 inference, it can't be combined with --fp16 false")
+
     model_name: str = args.pop("model")
     output_dir: str = args.pop("output_dir")
     output_srt: bool = args.pop("output_srt")
     srt_only: bool = args.pop("srt_only")
     language: str = args.pop("language")
+    device: str = args.pop("device")
+    parallel: int = max(1, args.pop("parallel"))
+    fp16: bool = args.pop("fp16")
+    flash_attention: bool = args.pop("flash_attention")
+    batch_size: int = args.pop("batch_size")
+    chunk_seconds: int = args.pop("chunk_seconds")
+    vaapi_device: str = args.pop("vaapi_device")
+    hwaccel: str = resolve_hwaccel(args.pop("hwaccel"), vaapi_device)
     
     os.makedirs(output_dir, exist_ok=True)
 
@@ -45,70 +97,241 @@ def main():
     elif language != "auto":
         args["language"] = language
         
-    model = whisper.load_model(model_name)
-    audios = get_audio(args.pop("video"))
+    if device == "cpu":
+        compute_type = "int8"
+    else:
+        compute_type = "float16" if fp16 else "float32"
+
+    model = load_model(model_name, device, compute_type, flash_attention and device == "cuda")
+
+    if batch_size > 1:
+        # split each file at VAD silences and decode the chunks as one batch
+        model = BatchedInferencePipeline(model)
+        args["batch_size"] = batch_size
+        args["chunk_length"] = chunk_seconds
+        # the pipeline defaults to one segment per chunk, keep Whisper's
+        # timestamp splits so subtitle cues stay short
+        args["without_timestamps"] = False
+
+    if device == "cuda":
+        warm_up(model, max(1, batch_size))
+
+    audios = get_audio(read_paths(args.pop("video")))
     subtitles = get_subtitles(
-        audios, output_srt or srt_only, output_dir, lambda audio_path: model.transcribe(audio_path, **args)
+        audios, output_srt or srt_only, output_dir, lambda audio_path: transcribe(model, audio_path, **args)
     )
 
-    if srt_only:
-        return
+    def overlay(path, srt_path):
+        try:
+            add_subtitles(path, srt_path, output_dir, hwaccel, vaapi_device)
+        finally:
+            if not output_srt:
+                os.remove(srt_path)
 
-    for path, srt_path in subtitles.items():
-        out_path = os.path.join(output_dir, f"{filename(path)}.mp4")
+    # subtitles are generated lazily, so each video is overlaid in the
+    # background while the next one is being transcribed
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        futures = []
 
-        print(f"Adding subtitles to {filename(path)}...")
+        for path, srt_path in subtitles:
+            # surface a failed overlay as soon as the current transcription
+            # ends, instead of after the whole batch has been transcribed
+            for future in futures:
+                if future.done():
+                    future.result()
 
-        video = ffmpeg.input(path)
-        audio = video.audio
+            if not srt_only:
+                futures.append(executor.submit(overlay, path, srt_path))
 
-        ffmpeg.concat(
-            video.filter('subtitles', srt_path, force_style="OutlineColour=&H40000000,BorderStyle=3"), audio, v=1, a=1
-        ).output(out_path).run(quiet=True, overwrite_output=True)
+    for future in futures:
+        future.result()
 
-        print(f"Saved subtitled video to {os.path.abspath(out_path)}.")
 
+def resolve_hwaccel(hwaccel: str, vaapi_device: str = None):
+    if hwaccel == "none":
+        return hwaccel
 
-def get_audio(paths):
-    temp_dir = tempfile.gettempdir()
+    encoders = get_encoders()
 
-    audio_paths = {}
+    def usable(name):
+        return HW_ENCODERS[name] in encoders and encoder_works(
+            HW_ENCODERS[name], vaapi_device if name == "vaapi" else None
+        )
 
-    for path in paths:
-        print(f"Extracting audio from {filename(path)}...")
-        output_path = os.path.join(temp_dir, f"{filename(path)}.wav")
+    if hwaccel == "auto":
+        return next((name for name in HW_ENCODERS if usable(name)), "none")
+
+    if not usable(hwaccel):
+        warnings.warn(
+            f"{HW_ENCODERS[hwaccel]} is not usable on this machine, falling back to software encoding.")
+        return "none"
 
-        ffmpeg.input(path).output(
-            output_path,
-            acodec="pcm_s16le", ac=1, ar="16k"
-        ).run(quiet=True, overwrite_output=True)
+    return hwaccel
 
-        audio_paths[path] = output_path
 
-    return audio_paths
+def add_subtitles(path: str, srt_path: str, output_dir: str, hwaccel: str = "none", vaapi_device: str = None):
+    out_path = os.path.join(output_dir, f"{filename(path)}.mp4")
 
+    tqdm.write(f"Adding subtitles to {filename(path)}...")
 
-def get_subtitles(audio_paths: list, output_srt: bool, output_dir: str, transcribe: callable):
-    subtitles_path = {}
+    video = ffmpeg.input(path)
+    # only the first audio track, as the old concat(..., a=1) graph did
+    audio = video["a:0"]
 
-    for path, audio_path in audio_paths.items():
-        srt_path = output_dir if output_srt else tempfile.gettempdir()
-        srt_path = os.path.join(srt_path, f"{filename(path)}.srt")
-        
-        print(
+    subtitled = video.filter('subtitles', srt_path, force_style="OutlineColour=&H40000000,BorderStyle=3")
+    global_args = ["-progress", "pipe:1", "-nostats", "-loglevel", "error"]
+    output_args = {}
+
+    if hwaccel == "nvenc":
+        output_args = dict(preset="p4", tune="hq", rc="vbr", cq=23)
+    elif hwaccel == "vaapi":
+        # the subtitles filter renders on the CPU, so upload the frames for the encoder
+        subtitled = subtitled.filter("format", "nv12").filter("hwupload")
+        global_args += ["-vaapi_device", vaapi_device]
+
+    if hwaccel != "none":
+        output_args["vcodec"] = HW_ENCODERS[hwaccel]
+
+    if get_audio_codec(path) in MP4_AUDIO_CODECS:
+        output_args["acodec"] = "copy"
+
+    process = ffmpeg.output(
+        subtitled, audio, out_path, **output_args
+    ).global_args(
+        *global_args
+    ).run_async(quiet=True, overwrite_output=True)
+
+    # drain stderr concurrently, otherwise a flood of decode errors fills the
+    # pipe and blocks ffmpeg before it reaches the end of the progress output
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    reader.start()
+
+    track_progress(process, get_duration(path), desc=filename(path))
+
+    process.wait()
+    reader.join()
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", None, b"".join(stderr))
+
+    tqdm.write(f"Saved subtitled video to {os.path.abspath(out_path)}.")
+
+
+def track_progress(process, duration: float, desc: str = None):
+    # bars from concurrent overlays get their own line and are cleared when
+    # done, and messages go through tqdm.write so they don't tear the bars
+    with tqdm(total=round(duration, 2), unit="s", desc=desc, leave=False, mininterval=0.1) as pbar:
+        # ffmpeg reports key=value lines; out_time_us is the position in the output
+        for line in process.stdout:
+            key, _, value = line.decode().strip().partition("=")
+
+            if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                pbar.update(round(min(int(value) / 1_000_000, duration) - pbar.n, 2))
+            elif key == "progress" and value == "end":
+                pbar.update(pbar.total - pbar.n)
+
+
+def load_model(model_name: str, device: str, compute_type: str = "default", flash_attention: bool = False):
+    key = (model_name, device, compute_type, flash_attention)
+
+    if key not in _MODEL_CACHE:
+        # ctranslate2 only accepts flash_attention from 4.3, so leave it out unless requested
+        model_kwargs = {"flash_attention": True} if flash_attention else {}
+
+        _MODEL_CACHE[key] = WhisperModel(
+            model_name, device=device, compute_type=compute_type, cpu_threads=os.cpu_count(),
+            **model_kwargs,
+        )
+
+    return _MODEL_CACHE[key]
+
+
+def warm_up(model, batch_size: int = 1):
+    # decode one second of silence per batch slot through the object that does
+    # the real transcription, so CUDA context setup and cuBLAS algorithm
+    # selection for the real shapes happen before the first file
+    audio = np.zeros(16_000 * batch_size, dtype=np.float32)
+    options = dict(
+        beam_size=5, language="en", vad_filter=False, without_timestamps=True, max_new_tokens=4
+    )
+
+    if batch_size > 1:
+        options["batch_size"] = batch_size
+        options["clip_timestamps"] = [
+            {"start": i * 16_000, "end": (i + 1) * 16_000} for i in range(batch_size)
+        ]
+
+    segments, _ = model.transcribe(audio, **options)
+    list(segments)
+
+
+def transcribe(model, audio_path: str, verbose: bool = False, **kwargs):
+    segments, info = model.transcribe(
+        audio_path, beam_size=5, vad_filter=True, **kwargs
+    )
+
+    if verbose:
+        tqdm.write(f"Detected language: {info.language}")
+
+    result = []
+
+    # segments are decoded lazily, so consume the generator here
+    for segment in segments:
+        if verbose:
+            tqdm.write(
+                f"[{format_timestamp(segment.start)} --> {format_timestamp(segment.end)}] {segment.text}"
+            )
+
+        result.append(segment)
+
+    return result
+
+
+def read_paths(paths):
+    for path in paths:
+        if path == "-":
+            # yield stdin paths as they arrive, so a producer can keep feeding
+            # files to the already loaded model instead of waiting for EOF
+            for line in iter(sys.stdin.readline, ""):
+                if line.strip():
+                    yield line.strip()
+        else:
+            yield path
+
+
+def get_audio(paths):
+    for path in paths:
+        if has_audio_stream(path):
+            yield path
+        else:
+            warnings.warn(f"{filename(path)} has no audio stream, skipping.")
+
+
+def get_subtitles(audio_paths: Iterable[str], output_srt: bool, output_dir: str, transcribe: callable):
+    # faster-whisper decodes and resamples the audio in-process, so the
+    # input files are passed straight through without extracting a WAV
+    for path in audio_paths:
+        tqdm.write(
             f"Generating subtitles for {filename(path)}... This might take a while."
         )
 
         warnings.filterwarnings("ignore")
-        result = transcribe(audio_path)
+        segments = transcribe(path)
         warnings.filterwarnings("default")
 
-        with open(srt_path, "w", encoding="utf-8") as srt:
-            write_srt(result["segments"], file=srt)
+        if output_srt:
+            srt_path = os.path.join(output_dir, f"{filename(path)}.srt")
+            srt = open(srt_path, "w", encoding="utf-8")
+        else:
+            # created only once transcription succeeded, with a unique name so
+            # files sharing a basename or concurrent runs can't clash
+            fd, srt_path = tempfile.mkstemp(suffix=".srt", dir=get_temp_dir())
+            srt = open(fd, "w", encoding="utf-8")
 
-        subtitles_path[path] = srt_path
+        with srt:
+            write_srt(segments, file=srt)
 
-    return subtitles_path
+        yield path, srt_path
 
 
 if __name__ == '__main__':
@@ -1,5 +1,12 @@
 import os
-from typing import Iterator, TextIO
+import av
+import tempfile
+import subprocess
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable, TextIO
+
+if TYPE_CHECKING:
+    from faster_whisper.transcribe import Segment
 
 
 def str2bool(string):
@@ -17,30 +24,96 @@ def format_timestamp(seconds: float, always_include_hours: bool = False):
     assert seconds >= 0, "non-negative timestamp expected"
     milliseconds = round(seconds * 1000.0)
 
-    hours = milliseconds // 3_600_000
-    milliseconds -= hours * 3_600_000
-
-    minutes = milliseconds // 60_000
-    milliseconds -= minutes * 60_000
-
-    seconds = milliseconds // 1_000
-    milliseconds -= seconds * 1_000
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1_000)
 
     hours_marker = f"{hours:02d}:" if always_include_hours or hours > 0 else ""
     return f"{hours_marker}{minutes:02d}:{seconds:02d},{milliseconds:03d}"
 
 
-def write_srt(transcript: Iterator[dict], file: TextIO):
+def write_srt(transcript: Iterable["Segment"], file: TextIO):
+    parts = []
+
     for i, segment in enumerate(transcript, start=1):
-        print(
+        parts.append(
             f"{i}\n"
-            f"{format_timestamp(segment['start'], always_include_hours=True)} --> "
-            f"{format_timestamp(segment['end'], always_include_hours=True)}\n"
-            f"{segment['text'].strip().replace('-->', '->')}\n",
-            file=file,
-            flush=True,
+            f"{format_timestamp(segment.start, always_include_hours=True)} --> "
+            f"{format_timestamp(segment.end, always_include_hours=True)}\n"
+            f"{segment.text.strip().replace('-->', '->')}\n\n"
         )
 
+    file.write("".join(parts))
+
+
+@lru_cache(maxsize=None)
+def get_encoders():
+    output = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True
+    ).stdout
+
+    # each encoder line looks like " V....D h264_nvenc  NVIDIA NVENC H.264 encoder"
+    return frozenset(
+        fields[1] for fields in map(str.split, output.splitlines()) if len(fields) > 1
+    )
+
+
+@lru_cache(maxsize=None)
+def encoder_works(encoder: str, vaapi_device: str = None):
+    # ffmpeg lists hardware encoders that were compiled in even when the
+    # hardware is missing, so encode a single frame to confirm it is usable
+    args = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+
+    if vaapi_device is not None:
+        args += ["-vaapi_device", vaapi_device]
+
+    args += ["-f", "lavfi", "-i", "color=size=256x256", "-frames:v", "1"]
+
+    if vaapi_device is not None:
+        args += ["-vf", "format=nv12,hwupload"]
+
+    args += ["-c:v", encoder, "-f", "null", "-"]
+
+    return subprocess.run(args, capture_output=True).returncode == 0
+
+
+@lru_cache(maxsize=64)
+def _probe(path: str, mtime: float):
+    # read the container headers in-process instead of spawning ffprobe
+    with av.open(path) as container:
+        return {
+            "duration": container.duration / av.time_base if container.duration else 0.0,
+            # codec of the first audio track, the one that gets transcribed and muxed
+            "audio_codec": next(
+                (stream.codec_context.name for stream in container.streams if stream.type == "audio"), None
+            ),
+        }
+
+
+def probe(path: str):
+    # keyed on mtime so a file rewritten in place is probed again
+    return _probe(os.path.abspath(path), os.path.getmtime(path))
+
+
+def get_duration(path: str):
+    return probe(path)["duration"]
+
+
+def get_audio_codec(path: str):
+    return probe(path)["audio_codec"]
+
+
+def has_audio_stream(path: str):
+    return probe(path)["audio_codec"] is not None
+
+
+def get_temp_dir():
+    # prefer tmpfs so intermediate files never touch the disk
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+
+    return tempfile.gettempdir()
+
 
 def filename(path):
     return os.path.splitext(os.path.basename(path))[0]
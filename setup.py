@@ -7,7 +7,12 @@ setup(
     py_modules=["auto_subtitle"],
     author="Miguel Piedrafita",
     install_requires=[
-        'openai-whisper',
+        'faster-whisper>=1.1.0',
+        'ctranslate2',
+        'numpy',
+        'ffmpeg-python',
+        'tqdm',
+        'av',
     ],
     description="Automatically generate and embed subtitles into your videos",
     entry_points={